@@ -0,0 +1,69 @@
+"""
+Dual view benchmark, measures the single image latency with and without the concurrent left/right halves
+
+Reverses a synthetic scene with config["dual_view_threads"] on and off and reports the median latency of
+each. The share of the latency spent in the block matching and occlusion fill is reported as well: their
+per-pixel loops hold the GIL and always run one view after the other, so only the remaining share can overlap.
+
+Usage:
+    python benchmarks/dual_view.py [--height H] [--width W] [--repeats N]
+"""
+import argparse
+import cProfile
+import os
+import pstats
+import statistics
+import time
+
+from synthetic import BENCHMARK_CONFIG, make_scene
+
+from bmarble.reverse import reverse, warmup
+
+
+def sequential_share(anaglyph, config):
+    """
+    Profiles one reversion, only the calling thread is profiled so the dual view threads must be off
+    :return: fraction of the time spent in correspondence.get_full_correspondences,
+        correspondence.rematch_invalid_correspondences and colorize.fill_occlusions
+    """
+    sequential = {("correspondence.py", "get_full_correspondences"),
+                  ("correspondence.py", "rematch_invalid_correspondences"),
+                  ("colorize.py", "fill_occlusions")}
+    profile = cProfile.Profile()
+    start = time.perf_counter()
+    profile.runcall(reverse, anaglyph, config)
+    total = time.perf_counter() - start
+    return sum(stats[3] for (filename, _, function), stats in pstats.Stats(profile).stats.items()
+               if (os.path.basename(filename), function) in sequential) / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--height", type=int, default=240)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    anaglyph, _ = make_scene(args.height, args.width)
+    config = {**BENCHMARK_CONFIG, "debug_images": False}
+    warmup(config)
+
+    sequential = {**config, "dual_view_threads": False}
+    print(f"{os.cpu_count()} CPUs, {args.height}x{args.width} frame, "
+          f"{sequential_share(anaglyph, sequential):.0%} of the time in the block matching and occlusion fill")
+    print(f"{'dual view':<10} {'median (s)':>11}")
+    medians = {}
+    for threads in (False, True):
+        run_config = {**config, "dual_view_threads": threads}
+        runs = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            reverse(anaglyph, run_config)
+            runs.append(time.perf_counter() - start)
+        medians[threads] = statistics.median(runs)
+        print(f"{'on' if threads else 'off':<10} {medians[threads]:>11.3f}")
+    print(f"speedup {medians[False] / medians[True]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Import time benchmark, tracks the cold start cost of the package
+
+Runs a fresh interpreter with -X importtime and checks that importing the entry point stays within budget
+and does not pull in the lazily loaded dependencies.
+
+Usage:
+    python benchmarks/import_time.py [--runs N] [--budget-ms MS]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cumulative import time allowed for bmarble.reverse, numpy included
+IMPORT_BUDGET_MS = 150
+
+# Dependencies that must only be imported at first use (or by warmup)
+LAZY_DEPENDENCIES = ("cv2", "scipy.ndimage")
+
+
+def measure_import(module="bmarble.reverse"):
+    """
+    Imports the module in a fresh interpreter
+    :param module: module to import
+    :return: (cumulative import time in ms, set of imported module names)
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    cumulative = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = (field.strip() for field in line[len("import time:"):].split("|"))
+        imported.add(name)
+        if name == module:
+            cumulative = int(cumulative_us) / 1000
+    return cumulative, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="number of fresh interpreters, the median is reported")
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS, help="import time budget")
+    args = parser.parse_args()
+
+    timings = []
+    imported = set()
+    for _ in range(args.runs):
+        cumulative, imported = measure_import()
+        timings.append(cumulative)
+    median = statistics.median(timings)
+
+    print(f"import bmarble.reverse: median {median:.1f} ms over {args.runs} runs "
+          f"(min {min(timings):.1f} ms, max {max(timings):.1f} ms), budget {args.budget_ms:.0f} ms")
+
+    failed = False
+    eager = [name for name in LAZY_DEPENDENCIES if name in imported]
+    if eager:
+        print(f"FAIL: imported eagerly: {', '.join(eager)}")
+        failed = True
+    if median > args.budget_ms:
+        print("FAIL: import time over budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""
+Matching cost benchmark, compares the SAD and census backends
+
+Runs both matching rounds on a synthetic scene with known disparities and reports the time spent and the
+fraction of correct blocks for each backend.
+
+Usage:
+    python benchmarks/matching_cost.py [--height H] [--width W] [--repeats N]
+"""
+import argparse
+import time
+
+from synthetic import BENCHMARK_CONFIG, make_scene, block_accuracy
+
+import bmarble.correspondence as correspondence
+import bmarble.utils as utils
+from bmarble.preprocessing import laplacianOfGaussian, census_transform
+
+BACKENDS = {
+    "sad": {"matching_cost": "sad"},
+    "census (LoG)": {"matching_cost": "census", "census_source": "log"},
+    "census (raw)": {"matching_cost": "census", "census_source": "raw"},
+}
+
+
+def match(anaglyph, config):
+    """
+    Runs the matching stages of the pipeline
+    :return: (seconds, block resolution left disparity map)
+    """
+    start = time.perf_counter()
+    channels = utils.get_channel_views(anaglyph)
+    log_left, log_right = laplacianOfGaussian(channels.red, channels.cyan, config)
+    if config["matching_cost"] == "census":
+        source = (log_left, log_right) if config["census_source"] == "log" else (channels.red, channels.cyan)
+        match_left, match_right = census_transform(*source, config)
+    else:
+        match_left, match_right = log_left, log_right
+
+    histograms = correspondence.new_histograms(log_left.shape, config)
+    dmap_left, dmap_right = correspondence.get_full_correspondences(match_left, match_right, config,
+                                                                    histograms=histograms)
+    new_window = correspondence.calculate_window(dmap_left, dmap_right, config, histograms=histograms)
+    dmap_left, _ = correspondence.rematch_invalid_correspondences(dmap_left, dmap_right, match_left, match_right,
+                                                                  new_window, config)
+    return time.perf_counter() - start, dmap_left
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--height", type=int, default=120)
+    parser.add_argument("--width", type=int, default=160)
+    parser.add_argument("--repeats", type=int, default=3, help="runs per backend, the best time is reported")
+    args = parser.parse_args()
+
+    anaglyph, disparity = make_scene(args.height, args.width)
+
+    print(f"{'backend':<14} {'time (s)':>9} {'exact':>7} {'within 1':>9}")
+    for name, overrides in BACKENDS.items():
+        config = {**BENCHMARK_CONFIG, **overrides}
+        runs = [match(anaglyph, config) for _ in range(args.repeats)]
+        seconds = min(run[0] for run in runs)
+        exact, close = block_accuracy(runs[0][1], disparity, config)
+        print(f"{name:<14} {seconds:>9.3f} {exact:>7.1%} {close:>9.1%}")
+
+
+if __name__ == "__main__":
+    main()
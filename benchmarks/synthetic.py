@@ -0,0 +1,93 @@
+"""
+Synthetic stereo scenes and configuration shared by the benchmarks
+
+Scenes have a textured background and a nearer rectangle, with known disparities, so the benchmarks can
+measure accuracy as well as speed.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bmarble.config import config_dict
+
+# Complete parameter set for the benchmarks, on top of the package defaults
+BENCHMARK_CONFIG = {
+    **config_dict,
+    "block_size": 8,
+    "max_window": 16,
+    "one_sided_search": True,
+    "no_vertical_search": True,
+    "vertical_window": 0,
+    "dw_threshold": 0.05,
+    "dw_extension": 1.2,
+    "sigma": 1.4,
+    "reciprocity": {
+        "threshold": 1,
+    },
+    "colorization": {
+        "min_matches": 20,
+        "min_window_size": 9,
+        "window_increment": 4,
+        "threshold": 10,
+        "erosion_kernel": 3,
+    },
+}
+
+BACKGROUND_DISPARITY = 4
+FOREGROUND_DISPARITY = 10
+
+
+def make_scene(height=120, width=160, seed=0, shift=0):
+    """
+    Builds a red-cyan anaglyph from a synthetic stereo pair
+    :param height:
+    :param width:
+    :param seed: texture seed
+    :param shift: horizontal position offset of the foreground rectangle, to animate scenes
+    :return: (RGB anaglyph, left disparity ground truth)
+    """
+    rng = np.random.default_rng(seed)
+
+    # Smooth grayscale texture, tinted so that every channel carries the same structure
+    texture = rng.random((height // 4 + 1, width // 4 + 1))
+    texture = np.kron(texture, np.ones((4, 4)))[:height, :width]
+    texture = texture + 0.25 * rng.random((height, width))
+    right = np.stack([texture * 0.9, texture, texture * 0.8], axis=2)
+    right = np.rint(255 * right / right.max()).astype(np.uint8)
+
+    # Disparity of each left pixel, a nearer rectangle over the background
+    disparity = np.full((height, width), BACKGROUND_DISPARITY)
+    top, left_edge = height // 4, (width // 4 + shift) % (width // 2)
+    disparity[top:top + height // 2, left_edge:left_edge + width // 3] = FOREGROUND_DISPARITY
+
+    # Left view samples the right one, left(x) = right(x - d)
+    columns = np.clip(np.arange(width)[np.newaxis, :] - disparity, 0, width - 1)
+    left = right[np.arange(height)[:, np.newaxis], columns]
+
+    anaglyph = np.stack([left[:, :, 0], right[:, :, 1], right[:, :, 2]], axis=2)
+    return anaglyph, disparity
+
+
+def block_accuracy(dmap_left, disparity, config=BENCHMARK_CONFIG):
+    """
+    Compares a block resolution left disparity map with the ground truth, on blocks of constant disparity
+    :param dmap_left: block resolution disparity map
+    :param disparity: pixel resolution ground truth
+    :param config:
+    :return: (fraction of exact blocks, fraction of blocks within one pixel)
+    """
+    bs = config["block_size"]
+    exact, close, total = 0, 0, 0
+    for by in range(disparity.shape[0] // bs):
+        for bx in range(disparity.shape[1] // bs):
+            block = disparity[by * bs:(by + 1) * bs, bx * bs:(bx + 1) * bs]
+            if block.min() != block.max():
+                continue
+            error = abs(abs(int(dmap_left[by, bx])) - block[0, 0])
+            exact += error == 0
+            close += error <= 1
+            total += 1
+    return exact / total, close / total
@@ -0,0 +1,75 @@
+"""
+Video pipeline benchmark, measures the sustained frame rate of the streaming reversion
+
+Generates a short anaglyph video from an animated synthetic scene, reverses it with an increasing number of
+thread and process workers and checks that the output has one stereo frame per input frame. Thread workers
+stop scaling early, as the occlusion fill holds the GIL; process workers include their start up time.
+
+Usage:
+    python benchmarks/video_pipeline.py [--height H] [--width W] [--frames N] [--workers N [N ...]]
+                                        [--executors {thread,process} [...]]
+"""
+import argparse
+import os
+import tempfile
+
+import cv2
+
+from synthetic import BENCHMARK_CONFIG, make_scene
+
+from bmarble.video import EXECUTORS, reverse_video
+
+
+def write_video(path, height, width, frames, fps=24):
+    """
+    Writes an anaglyph video of the synthetic scene, with the foreground moving one pixel per frame
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    for index in range(frames):
+        anaglyph, _ = make_scene(height, width, shift=index)
+        writer.write(cv2.cvtColor(anaglyph, cv2.COLOR_RGB2BGR))
+    writer.release()
+
+
+def count_frames(path):
+    """
+    Decodes a video to count its frames, the container frame count is not reliable
+    :return: (frames, frame width)
+    """
+    capture = cv2.VideoCapture(path)
+    frames, width = 0, 0
+    while True:
+        read, frame = capture.read()
+        if not read:
+            break
+        frames, width = frames + 1, frame.shape[1]
+    capture.release()
+    return frames, width
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--height", type=int, default=120)
+    parser.add_argument("--width", type=int, default=160)
+    parser.add_argument("--frames", type=int, default=24)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, os.cpu_count() or 1])
+    parser.add_argument("--executors", nargs="+", choices=EXECUTORS, default=list(EXECUTORS))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "anaglyph.mp4")
+        write_video(source, args.height, args.width, args.frames)
+
+        print(f"{'executor':>8} {'workers':>7} {'frames':>7} {'time (s)':>9} {'fps':>7}")
+        for executor in dict.fromkeys(args.executors):
+            for workers in dict.fromkeys(args.workers):
+                destination = os.path.join(directory, f"stereo_{executor}_{workers}.mp4")
+                stats = reverse_video(source, destination, BENCHMARK_CONFIG, workers=workers, executor=executor)
+                frames, width = count_frames(destination)
+                if frames != stats.frames or width != 2 * args.width:
+                    raise SystemExit(f"Expected {stats.frames} frames {2 * args.width} wide, got {frames} {width} wide")
+                print(f"{executor:>8} {workers:>7} {stats.frames:>7} {stats.seconds:>9.3f} {stats.fps:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
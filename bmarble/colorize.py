@@ -5,77 +5,83 @@ This code was adapted from https://github.com/andreldc/pixradio, all rights rese
 """
 
 import numpy as np
-import cv2 as cv
 
 
-from .utils import get_anaglyph_channels
+from . import utils
+from .utils import get_channel_views
+from .workspace import Workspace
 from .config import config_dict
+from .lazy import LazyModule
 
-COLORIZATION_CONFIG = None
+cv = LazyModule("cv2")
 
+# Largest difference between two guide channel values, once a cut threshold reaches it every pixel passes
+MAX_GUIDE_DIFFERENCE = 255
 
 
+def recover(anaglyph, l_disparity_map, r_disparity_map, channels=None, out=None):
+    """
+    Direct color transfer on the pixels with known disparity
+    :param anaglyph: BGR anaglyph, only read if channels is not given
+    :param l_disparity_map:
+    :param r_disparity_map:
+    :param channels: ChannelViews of the anaglyph, shared with the other stages
+    :param out: optional pair of uint8 BGR images to write the results into
+    :return: (left, right) partially recovered BGR images
+    """
+    if channels is None:
+        channels = get_channel_views(anaglyph, bgr=True)
 
+    y_axis, x_axis = channels.red.shape
 
+    left_red = channels.red
+    right_green = channels.green
+    right_blue = channels.blue
 
-def recover(anaglyph, l_disparity_map, r_disparity_map):
+    if out is None:
+        out = (np.empty((y_axis, x_axis, 3), 'uint8'), np.empty((y_axis, x_axis, 3), 'uint8'))
+    l_recovered, r_recovered = out
+    l_recovered.fill(0)
+    r_recovered.fill(0)
 
-    y_axis, x_axis, _ = anaglyph.shape
+    # For each row, each pixel p of the row at once - O(N)
+    columns = np.arange(x_axis)
+    for y in range(y_axis):
 
-    # Opens anaglyph and splits its channels = O(1)
-    l_channel, _, r1_channel, r2_channel = get_anaglyph_channels(anaglyph, avoid_image_show=True)
+        # Gets the disparity - O(1)
+        l_source = columns - l_disparity_map[y].astype(np.intp)
+        r_source = columns + r_disparity_map[y].astype(np.intp)
 
-    left_red = l_channel
-    right_green = r1_channel
-    right_blue = r2_channel
+        # If the disparity leads to a pixel within the image, copies color - O(1)
+        l_inside = l_source > 0
+        l_recovered[y, l_inside, 1] = right_green[y, l_source[l_inside]]
+        l_recovered[y, l_inside, 0] = right_blue[y, l_source[l_inside]]
 
-    left_green = np.zeros((y_axis, x_axis), 'uint8')
-    left_blue = np.zeros((y_axis, x_axis), 'uint8')
-    right_red = np.zeros((y_axis, x_axis), 'uint8')
+        r_inside = r_source < x_axis
+        r_recovered[y, r_inside, 2] = left_red[y, r_source[r_inside]]
 
-    # For each pixel p - O(N)
-    for y in range(y_axis):
-        for x in range(x_axis):
-
-            # Gets the disparity - O(1)
-            l_disparity = l_disparity_map[y, x]
-            r_disparity = r_disparity_map[y, x]
-
-            # If the disparity leads to a pixel within the image - O(1)
-            if x - l_disparity > 0:
-                # Copies color
-                left_green[y, x] = right_green[y, int(x - l_disparity)]
-                left_blue[y, x] = right_blue[y, int(x - l_disparity)]
-
-            # If the disparity leads to a pixel within the image - O(1)
-            if x + r_disparity < x_axis:
-                # Copies color
-                right_red[y, x] = left_red[y, int(x + r_disparity)]
-
-    # Gets valid mask from disparity map - O(1)
-    l_valid_mask = np.where(l_disparity_map != 0, 1, 0)
-    r_valid_mask = np.where(r_disparity_map != 0, 1, 0)
-
-    l_recovered = cv.merge((
-        np.where(l_valid_mask == 1, left_blue, 0),
-        np.where(l_valid_mask == 1, left_green, 0),
-        np.where(l_valid_mask == 1, left_red, 0)
-        )).astype("uint8")
-    r_recovered = cv.merge((
-        np.where(r_valid_mask == 1, right_blue, 0),
-        np.where(r_valid_mask == 1, right_green, 0),
-        np.where(r_valid_mask == 1, right_red, 0)
-        )).astype("uint8")
+    # Channels seen by each view are copied directly
+    l_recovered[:, :, 2] = left_red
+    r_recovered[:, :, 1] = right_green
+    r_recovered[:, :, 0] = right_blue
+
+    # Keeps only the pixels with valid disparity - O(1)
+    l_recovered[l_disparity_map == 0] = 0
+    r_recovered[r_disparity_map == 0] = 0
 
 
     return l_recovered, r_recovered
 
-def erode(l_reciprocity_mask_temp, r_reciprocity_mask_temp):
-    erosion_kernel = COLORIZATION_CONFIG["erosion_kernel"]
+def erode(l_reciprocity_mask_temp, r_reciprocity_mask_temp, config = config_dict, out = None):
+    erosion_kernel = config["colorization"]["erosion_kernel"]
     kernel = np.ones((erosion_kernel, erosion_kernel),np.uint8)
+    out = (None, None) if out is None else out
 
-    l_eroded = cv.erode(l_reciprocity_mask_temp, kernel, iterations = 1)
-    r_eroded = cv.erode(r_reciprocity_mask_temp, kernel, iterations = 1)
+    l_eroded, r_eroded = utils.run_dual(
+        lambda: cv.erode(l_reciprocity_mask_temp, kernel, dst=out[0], iterations = 1),
+        lambda: cv.erode(r_reciprocity_mask_temp, kernel, dst=out[1], iterations = 1),
+        config
+    )
 
 
 
@@ -96,205 +102,222 @@ def get_block(image, x, y, window_size):
     ''' Get a block from a given image at coordinates x,y '''
     half_window_size = int(window_size/2)
 
-    bordered = cv.copyMakeBorder(image, half_window_size, half_window_size,
-                                 half_window_size, half_window_size, cv.BORDER_REFLECT_101)
-
-    x_start = x
+    x_start = x - half_window_size
     x_end = x_start + window_size
-    y_start = y
+    y_start = y - half_window_size
     y_end = y_start + window_size
 
-    return bordered[y_start:y_end, x_start:x_end]
+    # Blocks inside the image are returned as views, without copying the image
+    if 0 <= y_start and y_end <= image.shape[0] and 0 <= x_start and x_end <= image.shape[1]:
+        return image[y_start:y_end, x_start:x_end]
+
+    # Otherwise out of bounds coordinates are mirrored, matching cv.BORDER_REFLECT_101
+    rows = reflect_101(np.arange(y_start, y_end), image.shape[0])
+    cols = reflect_101(np.arange(x_start, x_end), image.shape[1])
+    return image[np.ix_(rows, cols)]
+
+def reflect_101(indexes, length):
+    """
+    Mirrors out of bounds indexes around the first and last elements, without repeating them
+    """
+    indexes = np.abs(indexes)
+    return np.where(indexes >= length, 2 * (length - 1) - indexes, indexes)
 
 def get_invalid_borders(reciprocity):
     """
     Get the list of invalid pixels that are in the borders
     """
-    l_trim = np.zeros(reciprocity.shape)
-    l_trim[:, :-1] = reciprocity[:, 1:]
-
-    r_trim = np.zeros(reciprocity.shape)
-    r_trim[:, 1:] = reciprocity[:, :-1]
-
-    u_trim = np.zeros(reciprocity.shape)
-    u_trim[:-1, :] = reciprocity[1:, :]
-
-    b_trim = np.zeros(reciprocity.shape)
-    b_trim[1:, :] = reciprocity[:-1, :]
-
-    diff1 = (l_trim - reciprocity)
-    diff2 = (r_trim - reciprocity)
-    diff3 = (u_trim - reciprocity)
-    diff4 = (b_trim - reciprocity)
-
-    borders = np.where(diff1 > 0, 1, 0)
-    borders = np.where(diff2 > 0, 1, borders)
-    borders = np.where(diff3 > 0, 1, borders)
-    borders = np.where(diff4 > 0, 1, borders)
+    # Masks hold 0 or 1, so a border is an invalid pixel with at least one valid 4-neighbour
+    valid = reciprocity > 0
+    borders = np.zeros(reciprocity.shape, np.bool_)
+    borders[:, :-1] |= valid[:, 1:]
+    borders[:, 1:] |= valid[:, :-1]
+    borders[:-1, :] |= valid[1:, :]
+    borders[1:, :] |= valid[:-1, :]
+    borders &= ~valid
 
-
-    invalid = [np.where(borders == 1)][0]
+    invalid = np.nonzero(borders)
 
     return invalid
 
-def colorize(anaglyph, l_recovered, r_recovered, l_reciprocity_mask, r_reciprocity_mask, config = config_dict):
-
-    global COLORIZATION_CONFIG
-    COLORIZATION_CONFIG = config["colorization"]
-
-    y_axis, x_axis, _ = anaglyph.shape
-    img_area = y_axis*x_axis
-    scale_factor = img_area/166080
-
-    # Scales factors to adjust to image size - O(1)
-    min_matches      = int(scale_factor * COLORIZATION_CONFIG["min_matches"])
-    max_window_size  = int(y_axis/4)*2 - 1
-    min_window_size  = int(scale_factor * COLORIZATION_CONFIG["min_window_size"]/2)*2 + 1
-    window_increment = int(scale_factor * COLORIZATION_CONFIG["window_increment"]/2)*2 + 1
-
-    # Get anaglyph Channels - O(1)
-    red_channel, cyan_channel, _, _ = get_anaglyph_channels(anaglyph, avoid_image_show=True)
-
-    # Variable to store final image - O(1)
-    l_colorized = np.copy(l_recovered)
-    r_colorized = np.copy(r_recovered)
-
-    # Define temporary reciprocity mask to update iteratively - O(1)
-    l_reciprocity_mask_temp = np.copy(l_reciprocity_mask)
-    r_reciprocity_mask_temp = np.copy(r_reciprocity_mask)
-
-    # Erodes reciprocity masks = enhanced results
-    l_reciprocity_mask_temp, r_reciprocity_mask_temp = erode(l_reciprocity_mask_temp,
-                                                             r_reciprocity_mask_temp)
+def fill_occlusions(colorized, reciprocity_mask, guide_channel, known_channels, estimated_channels,
+                    min_matches, min_window_size, max_window_size, window_increment, threshold,
+                    window_sizes=None, cut_thds=None, max_passes=None, deadline=None, inpaint_radius=3):
+    """
+    Colorizes the invalid pixels of a single view, growing inwards from the borders of the valid region
+
+    Args:
+        colorized: partially recovered BGR image, updated in place
+        reciprocity_mask: eroded mask of valid pixels, updated in place
+        guide_channel: anaglyph plane seen by this view, used to weight similar pixels
+        known_channels (dict): BGR channel index -> anaglyph plane copied directly
+        estimated_channels (list): BGR channel indexes averaged from similar valid pixels
+        min_matches, min_window_size, max_window_size, window_increment: size scaled parameters
+        threshold: initial guide channel difference accepted for similar pixels
+        window_sizes, cut_thds (optional): int16 image sized buffers for the per pixel search state
+        max_passes (optional): maximum number of passes over the frontier, None for no limit
+        deadline (optional): Deadline, stops the passes once the colorization budget is spent
+        inpaint_radius: radius of the inpainting used on the pixels the passes could not fill
+
+    Returns:
+        the colorized image
+    """
+    y_axis, x_axis = reciprocity_mask.shape
 
     # Array to store actual window size for each colorized pixel
-    l_window_sizes = (np.ones((y_axis, x_axis))*min_window_size).astype('int16')
-    r_window_sizes = (np.ones((y_axis, x_axis))*min_window_size).astype('int16')
+    window_sizes = np.empty((y_axis, x_axis), 'int16') if window_sizes is None else window_sizes
+    cut_thds = np.empty((y_axis, x_axis), 'int16') if cut_thds is None else cut_thds
+    window_sizes.fill(min_window_size)
+    cut_thds.fill(threshold)
 
-    l_cut_thds = (np.ones((y_axis, x_axis))*COLORIZATION_CONFIG["threshold"]).astype('int16')
-    r_cut_thds = (np.ones((y_axis, x_axis))*COLORIZATION_CONFIG["threshold"]).astype('int16')
+    # Invalid pixels with a valid neighbour, as flat indexes in row-major order. The full image is only scanned
+    # once, afterwards the frontier is updated from the pixels filled on each pass
+    frontier = list(np.ravel_multi_index(get_invalid_borders(reciprocity_mask), (y_axis, x_axis)))
 
-    l_invalid_count = utils.count_if(l_reciprocity_mask_temp, 0)
-    r_invalid_count = utils.count_if(r_reciprocity_mask_temp, 0)
+    # While there are invalid borders - O(I.t) - I=Invalid pixels, t=Tries (max-min/inc)
+    passes = 0
+    while frontier:
 
+        # Bounded work, the remaining pixels get a cheap fallback
+        if (max_passes is not None and passes >= max_passes) or \
+           (deadline is not None and deadline.expired("colorization")):
+            break
+        passes += 1
 
+        next_frontier = set()
+        filled, exhausted = 0, 0
 
-
-    # While there are invalid pixels - O(I.) - I=Invalid pixels, t=Tries (max-min/inc)
-    while l_invalid_count > 0:
-
-        # Get invalid borders
-        l_invalid = get_invalid_borders(l_reciprocity_mask_temp)
-
-        # For each invalid pixel
-        for i in range(len(l_invalid[0])):
+        # For each invalid border pixel
+        for index in frontier:
 
             # Get pixel coordinates - O(1)
-            y = l_invalid[0][i]
-            x = l_invalid[1][i]
+            y, x = divmod(int(index), x_axis)
 
             # Get actual search window size and cut thd for the actual pixel - O(1)
-            window_size = l_window_sizes[y][x]
-            l_cut_thd = l_cut_thds[y][x]
+            window_size = window_sizes[y][x]
+            cut_thd = cut_thds[y][x]
 
             # Get block valid mask
-            l_reciprocity_mask_block = get_block(l_reciprocity_mask_temp, x, y, window_size)
+            reciprocity_mask_block = get_block(reciprocity_mask, x, y, window_size)
 
             # Get recovered block
-            l_recovered_block = get_block(l_colorized, x, y, window_size)
-            blue_block, green_block, red_block = cv.split(l_recovered_block)
+            recovered_block = get_block(colorized, x, y, window_size)
 
             # Get similarity weights from original channel and masks it
-            l_original = get_block(red_channel, x, y, window_size)
-            l_weights = get_weights(l_original)
+            original = get_block(guide_channel, x, y, window_size)
+            weights = get_weights(original)
 
             # Discards dissimilar pixels
-            l_cut_mask = np.where(l_weights > l_cut_thd, 0, 1)
-            l_cut_mask = np.where(l_reciprocity_mask_block == 1, l_cut_mask, 0)
-
-            # Masks blocks
-            green_block_masked = np.where(l_cut_mask == 1, green_block, 0)
-            blue_block_masked = np.where(l_cut_mask == 1, blue_block, 0)
+            cut_mask = np.where(weights > cut_thd, 0, 1)
+            cut_mask = np.where(reciprocity_mask_block == 1, cut_mask, 0)
 
-            count = utils.count_if(l_cut_mask, 1)
+            count = utils.count_if(cut_mask, 1)
             if count > min_matches:
 
-                red = anaglyph[y][x][2]
-
-                l_colorized[y][x][2] = red
-                l_colorized[y][x][1] = int(round(np.sum(green_block_masked)/count))
-                l_colorized[y][x][0] = int(round(np.sum(blue_block_masked)/count))
-
-                l_reciprocity_mask_temp[y][x] = 1
-                l_invalid_count -= 1
+                for channel, plane in known_channels.items():
+                    colorized[y][x][channel] = plane[y, x]
+                for channel in estimated_channels:
+                    # Masks blocks
+                    block_masked = np.where(cut_mask == 1, recovered_block[:, :, channel], 0)
+                    colorized[y][x][channel] = int(round(np.sum(block_masked)/count))
 
+                reciprocity_mask[y][x] = 1
+                filled += 1
 
+                # Its invalid neighbours become borders
+                for ny, nx in ((y, x - 1), (y, x + 1), (y - 1, x), (y + 1, x)):
+                    if 0 <= ny < y_axis and 0 <= nx < x_axis and reciprocity_mask[ny][nx] == 0:
+                        next_frontier.add(ny * x_axis + nx)
 
             else:
-                if l_window_sizes[y][x] + window_increment < max_window_size:
-                    l_window_sizes[y][x] = l_window_sizes[y][x] + window_increment
+                if window_sizes[y][x] + window_increment < max_window_size:
+                    window_sizes[y][x] = window_sizes[y][x] + window_increment
+                elif cut_thds[y][x] < MAX_GUIDE_DIFFERENCE:
+                    cut_thds[y][x] = cut_thds[y][x] + 1
                 else:
-                    l_cut_thds[y][x] = l_cut_thds[y][x] + 1
-
-
-    # While there are invalid pixels
-    while r_invalid_count > 0:
+                    # Only newly filled neighbours can still bring in matches
+                    exhausted += 1
 
-        # Get invalid borders
-        r_invalid = get_invalid_borders(r_reciprocity_mask_temp)
+                # Retried on the next pass
+                next_frontier.add(index)
 
-        # For each invalid pixel
-        for i in range(len(r_invalid[0])):
+        # Neighbours queued earlier on the pass may have been filled afterwards
+        frontier = sorted(i for i in next_frontier if reciprocity_mask.flat[i] == 0)
 
-            # Get pixel coordenates
-            y = r_invalid[0][i]
-            x = r_invalid[1][i]
+        # Nothing was filled and nothing can change on the next pass (e.g. frames too small for min_matches)
+        if filled == 0 and exhausted == len(frontier):
+            break
 
-            # Get actual search window size and cut thd for the actual pixel
-            window_size = r_window_sizes[y][x]
-            r_cut_thd = r_cut_thds[y][x]
+    # Pixels left by a cut short fill, or by a view without any valid pixel to grow from
+    if not reciprocity_mask.all():
+        inpaint_remaining(colorized, reciprocity_mask, known_channels, inpaint_radius)
+        if deadline is not None:
+            deadline.take("fill_inpainted")
 
-            # Get block valid mask
-            r_reciprocity_mask_block = get_block(r_reciprocity_mask_temp, x, y, window_size)
-
-            # Get recovered block
-            r_recovered_block = get_block(r_colorized, x, y, window_size)
-            blue_block, green_block, red_block = cv.split(r_recovered_block)
-
-            # Get similarity weights from original channel and masks it
-            r_original = get_block(cyan_channel, x, y, window_size)
-            r_weights = get_weights(r_original) #*r_reciprocity_mask_block
-
-            # Discards dissimilar pixels
-            r_cut_mask = np.where(r_weights > r_cut_thd, 0, 1)
-            r_cut_mask = np.where(r_reciprocity_mask_block == 1, r_cut_mask, 0)
+    return colorized
 
-            # Masks blocks
-            red_block_masked = r_cut_mask * red_block
-
-            count = utils.count_if(r_cut_mask, 1)
-
-            if count > min_matches:
-
-                red = int(round(np.sum(red_block_masked)/count))
-                green = anaglyph[y][x][1]
-                blue = anaglyph[y][x][0]
+def inpaint_remaining(colorized, reciprocity_mask, known_channels, inpaint_radius):
+    """
+    Fills the pixels still invalid with OpenCV's inpainting, fallback for a fill that was cut short or stuck
 
-                r_colorized[y][x][2] = red
-                r_colorized[y][x][1] = green
-                r_colorized[y][x][0] = blue
+    Args:
+        colorized: BGR image, updated in place
+        reciprocity_mask: mask of valid pixels, updated in place
+        known_channels (dict): BGR channel index -> anaglyph plane, copied over the inpainted values
+        inpaint_radius: inpainting neighbourhood radius
+    """
+    invalid = reciprocity_mask == 0
+    inpainted = cv.inpaint(colorized, invalid.astype(np.uint8), inpaint_radius, cv.INPAINT_TELEA)
+    colorized[invalid] = inpainted[invalid]
+    for channel, plane in known_channels.items():
+        colorized[:, :, channel][invalid] = plane[invalid]
+    reciprocity_mask[invalid] = 1
 
-                r_reciprocity_mask_temp[y][x] = 1
-                r_invalid_count -= 1
+def colorize(anaglyph, l_recovered, r_recovered, l_reciprocity_mask, r_reciprocity_mask, config = config_dict,
+             channels = None, workspace = None, deadline = None):
 
+    colorization_config = config["colorization"]
 
+    # Anaglyph planes, the anaglyph itself is only read if they are not given
+    if channels is None:
+        channels = get_channel_views(anaglyph, bgr=True)
 
-            else:
-                if r_window_sizes[y][x] + window_increment < max_window_size:
-                    r_window_sizes[y][x] = r_window_sizes[y][x] + window_increment
-                else:
-                    r_cut_thds[y][x] = r_cut_thds[y][x] + 1
+    y_axis, x_axis = channels.red.shape
+    img_area = y_axis*x_axis
+    scale_factor = img_area/166080
 
+    # Scales factors to adjust to image size - O(1)
+    min_matches      = int(scale_factor * colorization_config["min_matches"])
+    max_window_size  = int(y_axis/4)*2 - 1
+    min_window_size  = int(scale_factor * colorization_config["min_window_size"]/2)*2 + 1
+    window_increment = int(scale_factor * colorization_config["window_increment"]/2)*2 + 1
+    limits = (min_matches, min_window_size, max_window_size, window_increment, colorization_config["threshold"])
+    bounds = {"max_passes": config["max_fill_passes"], "deadline": deadline,
+              "inpaint_radius": config["inpaint_radius"]}
+
+    # Buffers come from the workspace, the results are only valid until its next use
+    workspace = Workspace() if workspace is None else workspace
+    buffers = {view: {name: workspace.buffer(f"{view}_{name}", (y_axis, x_axis), 'int16')
+                      for name in ("window_sizes", "cut_thds")}
+               for view in ("l", "r")}
 
+    # Variable to store final image - O(1)
+    l_colorized = workspace.buffer("l_colorized", l_recovered.shape, 'uint8')
+    r_colorized = workspace.buffer("r_colorized", r_recovered.shape, 'uint8')
+    np.copyto(l_colorized, l_recovered)
+    np.copyto(r_colorized, r_recovered)
+
+    # Erodes reciprocity masks = enhanced results, the eroded masks are updated iteratively
+    l_reciprocity_mask_temp, r_reciprocity_mask_temp = erode(
+        l_reciprocity_mask, r_reciprocity_mask, config,
+        out=(workspace.buffer("l_eroded", l_reciprocity_mask.shape, l_reciprocity_mask.dtype),
+             workspace.buffer("r_eroded", r_reciprocity_mask.shape, r_reciprocity_mask.dtype))
+    )
+
+    # Left view keeps the anaglyph red and estimates green and blue, the right view the opposite.
+    # Views are independent, but the per pixel loop holds the GIL, so they are filled one after the other
+    l_colorized = fill_occlusions(l_colorized, l_reciprocity_mask_temp, channels.red,
+                                  {2: channels.red}, [1, 0], *limits, **buffers["l"], **bounds)
+    r_colorized = fill_occlusions(r_colorized, r_reciprocity_mask_temp, channels.cyan,
+                                  {1: channels.green, 0: channels.blue}, [2], *limits, **buffers["r"], **bounds)
     return l_colorized, r_colorized
-
@@ -6,5 +6,107 @@ Created by Felipe Carneiro Machado
 """
 
 config_dict = {
+    # Side of the square blocks matched between the views, in pixels
+    "block_size": 8,
+    # Horizontal search window of the first round of matching, in pixels
+    "max_window": 32,
+    # Searches only towards the expected disparity direction (left view to the left, right view to the right)
+    "one_sided_search": True,
+    # Matches blocks on the same rows only, as the views of an anaglyph are rectified
+    "no_vertical_search": True,
+    # Vertical search window in pixels, only used without no_vertical_search
+    "vertical_window": 0,
+    # Minimum share of the disparity histogram a disparity needs to bound the rematch window
+    "dw_threshold": 0.05,
+    # Multiplicative margin applied to the rematch window
+    "dw_extension": 1.2,
+    # Standard deviation of the Laplacian of Gaussian
+    "sigma": 1.4,
+    "reciprocity": {
+        # Maximum difference between the left and right disparities of a valid correspondence
+        "threshold": 1,
+    },
+    "colorization": {
+        # Similar valid pixels needed to estimate an occluded pixel
+        "min_matches": 20,
+        # Initial size and growth step of the window searched around an occluded pixel
+        "min_window_size": 9,
+        "window_increment": 4,
+        # Initial guide channel difference accepted for similar pixels, raised once the window stops growing
+        "threshold": 10,
+        # Size of the erosion applied to the reciprocity masks before colorization
+        "erosion_kernel": 3,
+    },
+    # Search window used on the rematch round: "global" computes a single window for the whole image,
+    # "region" computes one window per region from local disparity histograms
+    "window_mode": "global",
+    # Region dimensions in blocks (rows, cols), None spans the whole axis (e.g. (4, None) = 4 block-row stripes)
+    "region_size": (4, None),
+    # Blocks a region needs for its own window, smaller regions use the global window
+    "min_region_blocks": 32,
+    # Block matching cost: "sad" over the LoG images, or "census" for Hamming distances between census transforms
+    "matching_cost": "sad",
+    # Census neighbourhood size, odd and at most 7 so the bit string fits an uint64
+    "census_window": 5,
+    # Image the census transform is computed on: "log" for the LoG images, "raw" for the anaglyph planes
+    "census_source": "log",
+    # Runs the second round of matching over the blocks outside the calculated window
+    "rematch": True,
+    # Refines the disparity maps with a morphological closing
+    "refine": True,
+    # Maximum number of passes of the occlusion fill, None for no limit. Pixels left are inpainted
+    "max_fill_passes": None,
+    # Radius of the inpainting fallback of the occlusion fill
+    "inpaint_radius": 3,
+    # Writes the intermediate disparity maps of the refinement to the working directory, for debugging
+    "debug_images": True,
+    # Runs the left and right halves of the LoG, census, refinement, erosion and color conversion stages
+    # concurrently on a thread pool. Off by default: the block matching and occlusion fill loops hold the GIL, take
+    # most of the time of a frame and always run one view after the other, so the gain is small and needs several
+    # CPUs (see benchmarks/dual_view.py). Videos scale through reverse_video's process workers instead
+    "dual_view_threads": False,
+}
 
-}
\ No newline at end of file
+# Named quality presets, each overrides the matching, refinement and colorization settings above
+presets = {
+    "fast": {
+        "window_mode": "global",
+        "rematch": False,
+        "refine": False,
+        "max_fill_passes": 4,
+    },
+    "balanced": {
+        "window_mode": "global",
+        "rematch": True,
+        "refine": True,
+        "max_fill_passes": 16,
+    },
+    "quality": {
+        "window_mode": "global",
+        "rematch": True,
+        "refine": True,
+        "max_fill_passes": None,
+    },
+}
+
+
+def with_defaults(config):
+    """
+    Completes a configuration with the defaults of config_dict, so that configurations written before a
+    parameter was added keep working
+    :param config: configuration dictionary, possibly missing parameters
+    :return: new configuration dictionary
+    """
+    return {**config_dict, **config}
+
+
+def get_preset(name, config = config_dict):
+    """
+    Applies a quality preset over a configuration
+    :param name: "fast", "balanced" or "quality"
+    :param config: configuration dictionary the preset is applied to, accepts default
+    :return: new configuration dictionary
+    """
+    if name not in presets:
+        raise ValueError(f"Unknown preset {name!r}, expected one of {', '.join(presets)}")
+    return {**with_defaults(config), **presets[name]}
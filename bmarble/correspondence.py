@@ -23,38 +23,63 @@ def sad(leftY, leftX, rightY, rightX, log_left, log_right, config=config_dict):
     :return:
     """
     # Alias to shorten the expression
-    with config["block_size"] as bs:
-        return np.sum(np.abs(log_left[leftY:leftY+bs, leftX:leftX+bs] - log_right[rightY:rightY+bs, rightX:rightX+bs]))
+    bs = config["block_size"]
+    return np.sum(np.abs(log_left[leftY:leftY+bs, leftX:leftX+bs] - log_right[rightY:rightY+bs, rightX:rightX+bs]))
+
+
+def hamming(leftY, leftX, rightY, rightX, census_left, census_right, config=config_dict):
+    """
+    Computes the Hamming distance between two blocks of census transformed images
+    :param leftY:
+    :param leftX:
+    :param rightY:
+    :param rightX:
+    :param census_left: packed census bit strings of the left channel
+    :param census_right: packed census bit strings of the right channel
+    :param config:
+    :return: number of differing bits over the block
+    """
+    bs = config["block_size"]
+    return np.sum(np.bitwise_count(census_left[leftY:leftY+bs, leftX:leftX+bs] ^ census_right[rightY:rightY+bs, rightX:rightX+bs]))
+
+
+# Matching cost backends, selected by config["matching_cost"]
+MATCHING_COSTS = {
+    "sad": sad,
+    "census": hamming,
+}
 
 
 # noinspection DuplicatedCode
 def minimize_sad_l2r(x, y, log_left, log_right, hor_window, config = config_dict):
     """
     Finds the correspondent block through SAD minimization for the left channel
+    The cost minimized is chosen by config["matching_cost"], SAD by default
     :param x: original x coordinate
     :param y: original y coordinate
-    :param log_left:
-    :param log_right:
+    :param log_left: LoG (or census transformed) left channel
+    :param log_right: LoG (or census transformed) right channel
     :param hor_window: horizontal search window size
     :param config:
     :return: correspondent block coordinates
     """
 
     # Initializaton
+    cost = MATCHING_COSTS[config["matching_cost"]]
     best_sad = np.inf
     best_coord = (None, None)
 
     # Limits of the search window, considering the asymmetry and lack of vertical disparity
     xmin = x - hor_window
-    xmax = x if config["one_sided_search"] else x + hor_window + 1
+    xmax = x + 1 if config["one_sided_search"] else x + hor_window + 1
 
-    ymin, ymax = (y, y) if config["no_vertical_search"] else (y - config["vertical_window"], y + config["vertical_window"] + 1)
+    ymin, ymax = (y, y + 1) if config["no_vertical_search"] else (y - config["vertical_window"], y + config["vertical_window"] + 1)
 
     # Iteration through search window
     for iterX in range(xmin, xmax):
         for iterY in range(ymin, ymax):
-            if utils.valid_block(iterY, iterX, log_left.shape):
-                current_sad = sad(y, x, iterY, iterX, log_left, log_right)
+            if utils.valid_block(iterY, iterX, log_left.shape, config):
+                current_sad = cost(y, x, iterY, iterX, log_left, log_right, config)
                 if current_sad < best_sad:
                     best_sad = current_sad
                     best_coord = (iterY, iterX)
@@ -66,16 +91,18 @@ def minimize_sad_l2r(x, y, log_left, log_right, hor_window, config = config_dict
 def minimize_sad_r2l(x, y, log_left, log_right, hor_window, config = config_dict):
     """
     Finds the correspondent block through SAD minimization for the right channel
+    The cost minimized is chosen by config["matching_cost"], SAD by default
     :param x: original x coordinate
     :param y: original y coordinate
-    :param log_left:
-    :param log_right:
+    :param log_left: LoG (or census transformed) left channel
+    :param log_right: LoG (or census transformed) right channel
     :param hor_window: horizontal search window size
     :param config:
     :return: correspondent block coordinates
     """
 
     # Initialization
+    cost = MATCHING_COSTS[config["matching_cost"]]
     best_sad = np.inf
     best_coord = (None, None)
 
@@ -83,92 +110,217 @@ def minimize_sad_r2l(x, y, log_left, log_right, hor_window, config = config_dict
     xmin = x if config["one_sided_search"] else x - hor_window
     xmax = x + hor_window + 1
 
-    ymin, ymax = (y, y) if config["no_vertical_search"] else (y - config["vertical_window"], y + config["vertical_window"] + 1)
+    ymin, ymax = (y, y + 1) if config["no_vertical_search"] else (y - config["vertical_window"], y + config["vertical_window"] + 1)
 
     # Iteration through search window
     for iterX in range(xmin, xmax):
         for iterY in range(ymin, ymax):
-            if utils.valid_block(iterY, iterX, log_left.shape):
-                current_sad = sad(iterY, iterX, y, x, log_left, log_right)
+            if utils.valid_block(iterY, iterX, log_left.shape, config):
+                current_sad = cost(iterY, iterX, y, x, log_left, log_right, config)
                 if current_sad < best_sad:
                     best_sad = current_sad
                     best_coord = (iterY, iterX)
 
     return best_coord
 
-# Convenience function to update disparity maps
-def update_dmap(org, found, dmap, bs):
-    dmap[org[0]:org[0] + bs, org[1]:org[1] + bs] = np.ones((bs, bs)) * found[1] - org[1]
+# Convenience function to update disparity maps, which hold one disparity per block
+def update_dmap(block, org, found, dmap):
+    dmap[block] = found[1] - org[1]
+
+def block_grid_shape(dimensions, config = config_dict):
+    """
+    Computes the number of blocks along each axis of the image
+    :param dimensions: image dimensions
+    :param config: config dictionary, supports default
+    :return: (vertical, horizontal) number of blocks
+    """
+    bs = config["block_size"]
+    return -(-dimensions[0] // bs), -(-dimensions[1] // bs)
+
+def expand_dmap(dmap, dimensions, config = config_dict, out = None):
+    """
+    Expands a block resolution disparity map to pixel resolution
+    :param dmap: disparity map, one value per block
+    :param dimensions: image dimensions
+    :param config: config dictionary, supports default
+    :param out: optional array of shape (blocks * block_size) along each axis to write the result into
+    :return: disparity map, one value per pixel
+    """
+    bs = config["block_size"]
+    if out is None:
+        out = np.empty((dmap.shape[0] * bs, dmap.shape[1] * bs), dtype=dmap.dtype)
+    # Broadcasts each block value over its pixels, without intermediate copies
+    out.reshape(dmap.shape[0], bs, dmap.shape[1], bs)[...] = dmap[:, np.newaxis, :, np.newaxis]
+    return out[:dimensions[0], :dimensions[1]]
 
-def get_full_correspondences(log_left, log_right, config = config_dict):
+def region_grid_shape(grid_shape, config = config_dict):
+    """
+    Computes the number of regions along each axis used for the search window histograms
+    :param grid_shape: number of blocks along each axis
+    :param config: config dictionary, supports default
+    :return: (vertical, horizontal) number of regions, (1, 1) on global window mode
+    """
+    if config["window_mode"] == "global":
+        return 1, 1
+    return tuple(-(-n // (size or n)) for n, size in zip(grid_shape, config["region_size"]))
+
+def region_index(by, bx, config = config_dict):
+    """
+    Returns the region containing the block at the given block indexes, accepts index arrays
+    :param by:
+    :param bx:
+    :param config:
+    :return: (vertical, horizontal) region index
+    """
+    if config["window_mode"] == "global":
+        return 0, 0
+    rows, cols = config["region_size"]
+    return (by // rows if rows else 0,
+            bx // cols if cols else 0)
+
+def new_histograms(dimensions, config = config_dict, workspace = None):
+    """
+    Allocates the disparity histograms filled during the first round of matching
+    :param dimensions: image dimensions
+    :param config: config dictionary, supports default
+    :param workspace: Workspace to take the histograms from, allocates them if not given
+    :return: zeroed array with one histogram per region
+    """
+    grid_shape = block_grid_shape(dimensions, config)
+    shape = region_grid_shape(grid_shape, config) + (config["max_window"] + 1,)
+    if workspace is None:
+        return np.zeros(shape, dtype=np.int64)
+    return workspace.zeros("histograms", shape, np.int64)
+
+def get_full_correspondences(log_left, log_right, config = config_dict, histograms = None, out = None,
+                             deadline = None):
     """
     Computes the full disparity map with a large initial window
-    :param log_left: Laplacian of Gaussian preprocessed left channel
-    :param log_right: Laplacian of Gaussian preprocessed right channel
+    :param log_left: Laplacian of Gaussian preprocessed left channel, census transformed on the census cost
+    :param log_right: Laplacian of Gaussian preprocessed right channel, census transformed on the census cost
     :param config: config dictionary, supports default
-    :return: (left, right) disparity map
+    :param histograms: optional array from new_histograms, accumulates the disparity histogram of each region
+    :param out: optional pair of int16 arrays of block_grid_shape to write the results into
+    :param deadline: optional Deadline, block rows left when the matching budget runs out keep zero disparity
+    :return: (left, right) disparity map, one int16 disparity per block (see expand_dmap)
     """
 
     # Initialization
     dimensions = log_left.shape
-    dmap_left = np.zeros_like(log_left)
-    dmap_right = np.zeros_like(log_right)
+    if out is None:
+        out = (np.empty(block_grid_shape(dimensions, config), dtype=np.int16),
+               np.empty(block_grid_shape(dimensions, config), dtype=np.int16))
+    dmap_left, dmap_right = out
+    dmap_left.fill(0)
+    dmap_right.fill(0)
 
 
 
-    # Iterating over image blocks
-    for y in range(0, dimensions[0], config["block_size"]):
-        for x in range(0, dimensions[1], config["block_size"]):
+    # Iterating over image blocks, the last row/column of blocks is aligned to the image border
+    for by, y in enumerate(utils.block_origins(dimensions[0], config)):
+        if deadline is not None and deadline.expired("matching"):
+            deadline.take("matching_truncated")
+            break
+        for bx, x in enumerate(utils.block_origins(dimensions[1], config)):
             # Finding correspondences
-            left_match = minimize_sad_l2r(x, y, log_left, log_right, config["max_window"])
-            right_match = minimize_sad_r2l(x, y, log_left, log_right, config["max_window"])
+            left_match = minimize_sad_l2r(x, y, log_left, log_right, config["max_window"], config)
+            right_match = minimize_sad_r2l(x, y, log_left, log_right, config["max_window"], config)
             # Writing to disparity map
-            update_dmap((y, x), left_match, dmap_left, config["block_size"])
-            update_dmap((y, x), right_match, dmap_right, config["block_size"])
+            update_dmap((by, bx), (y, x), left_match, dmap_left)
+            update_dmap((by, bx), (y, x), right_match, dmap_right)
+            # Every block has the same area, so counting blocks yields the same normalized histogram as pixels
+            if histograms is not None:
+                histogram = histograms[region_index(by, bx, config)]
+                histogram[abs(dmap_left[by, bx])] += 1
+                histogram[abs(dmap_right[by, bx])] += 1
 
     return dmap_left, dmap_right
 
-def calculate_window(dmap_left, dmap_right, config = config_dict):
+def window_from_histogram(histogram, config = config_dict):
     """
-    Calculates the new search window based on the disparity map
-    :param dmap_left:
-    :param dmap_right:
+    Picks the search window from a disparity histogram
+    :param histogram: disparity occurrence counts, indexed by absolute disparity
     :param config:
-    :return:
+    :return: search window, at most max_window, which is also returned if no disparity reaches the threshold
     """
-    # Computes the histogram
-    values =  np.concatenate([np.abs(dmap_left.flatten()), np.abs(dmap_right.flatten())])
-    histogram = np.bincount(values, minlength=config["max_window"]+1)
-    histogram = histogram / np.sum(histogram)
+    total = np.sum(histogram)
+    if total == 0:
+        return config["max_window"]
+    histogram = histogram / total
     # Iterates backwards over the histogram until the first element above threshold
-    for i in range(len(histogram), -1, -1):
+    for i in range(len(histogram) - 1, -1, -1):
         if histogram[i] >= config["dw_threshold"]:
-            return round(i * config["dw_extension"]) # Extends the window by a small multiplicative factor
+            # Extends the window by a small multiplicative factor, never past the first round's window
+            return min(round(i * config["dw_extension"]), config["max_window"])
+    return config["max_window"]
+
+def calculate_window(dmap_left, dmap_right, config = config_dict, histograms = None):
+    """
+    Calculates the new search window based on the disparity map
+    :param dmap_left: block resolution disparity map
+    :param dmap_right: block resolution disparity map
+    :param config:
+    :param histograms: histograms accumulated by get_full_correspondences, skips recomputing them from the maps
+    :return: search window, or an array with one window per region on region window mode
+    """
+    if histograms is None:
+        # Computes the histograms from the disparity of each block
+        histograms = np.zeros(region_grid_shape(dmap_left.shape, config) + (config["max_window"] + 1,),
+                              dtype=np.int64)
+        regions = region_index(*np.indices(dmap_left.shape), config)
+        for dmap in (dmap_left, dmap_right):
+            np.add.at(histograms, regions + (np.minimum(np.abs(dmap), config["max_window"]),), 1)
 
+    global_window = window_from_histogram(histograms.sum(axis=(0, 1)), config)
+    if config["window_mode"] == "global":
+        return global_window
 
-def rematch_invalid_correspondences(dmap_left, dmap_right, log_left, log_right, new_window, config = config_dict):
+    # On regions with few blocks a single mismatch already passes dw_threshold, those keep the global window
+    windows = np.full(histograms.shape[:2], global_window, dtype=np.int64)
+    for index in np.ndindex(windows.shape):
+        # Every block adds one entry per view
+        if np.sum(histograms[index]) // 2 >= config["min_region_blocks"]:
+            windows[index] = window_from_histogram(histograms[index], config)
+    return windows
+
+def rematch_invalid_correspondences(dmap_left, dmap_right, log_left, log_right, new_window, config = config_dict,
+                                    deadline = None):
     """
     Uses the calculated window to get correspondences to the invalid blocks
-    :param dmap_left:
-    :param dmap_right:
+    :param dmap_left: block resolution disparity map
+    :param dmap_right: block resolution disparity map
     :param log_left:
     :param log_right:
-    :param new_window:
+    :param new_window: search window, or per region array of windows from calculate_window
     :param config:
+    :param deadline: optional Deadline, blocks left when the rematch budget runs out keep their first match
     :return: tuple of updated dmaps
     """
-    # Get invalid matches by their top right coordinate
-    invalid_left_coords = filter(lambda c: c[0] % config["block_size"] == 0 and c[1] % config["block_size"] == 0,
-                                 zip(*np.where(np.abs(dmap_left) > new_window)))
-    invalid_right_coords = filter(lambda c: c[0] % config["block_size"] == 0 and c[1] % config["block_size"] == 0,
-                                 zip(*np.where(np.abs(dmap_right) > new_window)))
-
-    # Rematch at the invalid coordinates
-    for y, x in invalid_left_coords:
-        match = minimize_sad_l2r(x, y, log_left, log_right, new_window)
-        update_dmap((y, x), match, dmap_left, config["block_size"])
-    for y, x in invalid_right_coords:
-        match = minimize_sad_r2l(x, y, log_left, log_right, new_window)
-        update_dmap((y, x), match, dmap_right, config["block_size"])
+    y_origins = utils.block_origins(log_left.shape[0], config)
+    x_origins = utils.block_origins(log_left.shape[1], config)
+
+    # Search window of each block
+    windows = np.asarray(new_window)
+    if windows.ndim:
+        windows = windows[region_index(*np.indices(dmap_left.shape), config)]
+    windows = np.broadcast_to(windows, dmap_left.shape)
+
+    # Get invalid matches by their block indexes
+    invalid_left_blocks = np.argwhere(np.abs(dmap_left) > windows)
+    invalid_right_blocks = np.argwhere(np.abs(dmap_right) > windows)
+
+    # Both views advance together in row-major order, so a deadline cuts them at the same place
+    blocks = sorted([(by, bx, minimize_sad_l2r, dmap_left) for by, bx in invalid_left_blocks] +
+                    [(by, bx, minimize_sad_r2l, dmap_right) for by, bx in invalid_right_blocks],
+                    key=lambda block: block[:2])
+
+    # Rematch at the invalid blocks, each block with the window of its region
+    for by, bx, minimize, dmap in blocks:
+        if deadline is not None and deadline.expired("rematch"):
+            deadline.take("rematch_truncated")
+            break
+        y, x = y_origins[by], x_origins[bx]
+        match = minimize(x, y, log_left, log_right, int(windows[by, bx]), config)
+        update_dmap((by, bx), (y, x), match, dmap)
 
     return dmap_left, dmap_right
@@ -0,0 +1,58 @@
+"""
+Latency budget for anytime reversion, stages cut their work short once their share of it is spent
+"""
+import threading
+import time
+
+# Fraction of the budget that may be spent by the end of each stage, the rest is kept for the following ones
+STAGE_BUDGETS = {
+    "matching": 0.4,
+    "rematch": 0.5,
+    "refinement": 0.6,
+    "colorization": 0.9,
+}
+
+
+class Deadline:
+    """
+    Time budget shared by the stages of a reversion, records the shortcuts taken to meet it
+
+    The clock starts when the deadline is created. With seconds=None there is no time limit, but shortcuts
+    taken for other reasons (e.g. a preset's fill pass cap) are still recorded. The shortcuts are
+    "matching_truncated", "rematch_truncated", "rematch_skipped", "refinement_skipped" and "fill_inpainted".
+    """
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.start = time.perf_counter()
+        self.shortcuts = []
+        # Both halves of the dual view stages may record shortcuts
+        self._lock = threading.Lock()
+
+    def elapsed(self):
+        """
+        Seconds since the deadline was created
+        """
+        return time.perf_counter() - self.start
+
+    def expired(self, stage=None):
+        """
+        Checks whether the budget share of a stage is spent
+        :param stage: key of STAGE_BUDGETS, None for the whole budget
+        :return: True if the stage should stop
+        """
+        if self.seconds is None:
+            return False
+        return self.elapsed() >= self.seconds * STAGE_BUDGETS.get(stage, 1)
+
+    def take(self, shortcut):
+        """
+        Records a shortcut, each one is reported once
+        :param shortcut: shortcut name
+        """
+        with self._lock:
+            if shortcut not in self.shortcuts:
+                self.shortcuts.append(shortcut)
+
+    def __repr__(self):
+        return f"Deadline(seconds={self.seconds}, elapsed={self.elapsed():.3f}, shortcuts={self.shortcuts})"
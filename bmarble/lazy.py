@@ -0,0 +1,35 @@
+"""
+Lazy loading of heavy dependencies, keeps the package import cheap for short-lived workers
+"""
+import importlib
+
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported on its first attribute access
+
+    Attributes are cached on the proxy after their first lookup, so later accesses cost the same as a
+    regular module attribute.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        """
+        Imports the wrapped module, if it was not imported yet
+        :return: the wrapped module
+        """
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        value = getattr(self.load(), attr)
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
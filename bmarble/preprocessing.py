@@ -4,23 +4,25 @@ Laplacian of Gaussian pre-processing for color independent representation
 Created by Felipe Carneiro Machado
 06/08/2025
 """
+from functools import lru_cache
+
 from bmarble.config import config_dict
+from bmarble.lazy import LazyModule
+from bmarble.workspace import Workspace
+import bmarble.utils as utils
 
 import numpy as np
-from scipy import ndimage
+
+ndimage = LazyModule("scipy.ndimage")
 
 
-def laplacianOfGaussian(left, right, config = config_dict):
+@lru_cache
+def log_kernel(sigma):
     """
-    Computes the LoG for the images, creating a color independent representation
-    :param left: left channel
-    :param right: right channel
-    :param config: configuration dictionary, accepts default
-    :return: tuple(numpy matrix, numpy matrix): LoG processed pair
+    Builds the zero-sum LoG kernel, once per sigma
+    :param sigma: gaussian standard deviation
+    :return: numpy matrix, read only
     """
-
-    sigma = config['sigma']
-
     size = int(2*(np.ceil(3*sigma))+1)
 
     # Creates the kernel to convolve with channels
@@ -30,13 +32,70 @@ def laplacianOfGaussian(left, right, config = config_dict):
 
     # Makes sure the kernel is zero-sum
     kernel = kernel - np.mean(kernel)
-    kern_size = kernel.shape[0]
+    kernel.flags.writeable = False
+    return kernel
+
+
+def laplacianOfGaussian(left, right, config = config_dict, out = None):
+    """
+    Computes the LoG for the images, creating a color independent representation
+    :param left: left channel plane
+    :param right: right channel plane
+    :param config: configuration dictionary, accepts default
+    :param out: optional pair of float64 arrays to write the results into
+    :return: tuple(numpy matrix, numpy matrix): LoG processed pair
+    """
+    out = (np.float64, np.float64) if out is None else out
+
+    kernel = log_kernel(config['sigma'])
 
 
     # applying filter
-    log_left = ndimage.convolve(left.astype(np.float64), kernel, mode='constant')
-    log_right = ndimage.convolve(right.astype(np.float64), kernel, mode='constant')
+    # Single channel planes are convolved directly into float64, without an intermediate float copy
+    log_left, log_right = utils.run_dual(
+        lambda: ndimage.convolve(left, kernel, output=out[0], mode='constant'),
+        lambda: ndimage.convolve(right, kernel, output=out[1], mode='constant'),
+        config
+    )
 
     return log_left, log_right
 
 
+def census_transform(left, right, config = config_dict, workspace = None):
+    """
+    Computes the census transform of the images, a bit string per pixel that encodes which neighbours are
+    darker than the pixel itself. Used by the census matching cost
+    :param left: left channel (LoG or raw plane, see config["census_source"])
+    :param right: right channel
+    :param config: configuration dictionary, accepts default
+    :param workspace: Workspace holding the results and scratch buffers, allocates them if not given
+    :return: tuple(numpy matrix, numpy matrix): uint64 packed census pair
+    """
+    window = config["census_window"]
+    if window % 2 == 0 or window**2 - 1 > 64:
+        raise ValueError(f"census_window must be odd and at most 7 to fit 64 bits, got {window}")
+
+    workspace = Workspace() if workspace is None else workspace
+    half = window // 2
+    offsets = [(dy, dx) for dy in range(-half, half + 1) for dx in range(-half, half + 1) if (dy, dx) != (0, 0)]
+
+    def transform(image, view):
+        y_axis, x_axis = image.shape
+
+        # Borders are extended with the edge pixels, so the comparisons there are against copies of them
+        padded = workspace.buffer(f"{view}_census_padded", (y_axis + 2*half, x_axis + 2*half), image.dtype)
+        padded[half:half + y_axis, half:half + x_axis] = image
+        padded[:half, half:half + x_axis] = image[0]
+        padded[half + y_axis:, half:half + x_axis] = image[-1]
+        padded[:, :half] = padded[:, half:half + 1]
+        padded[:, half + x_axis:] = padded[:, half + x_axis - 1:half + x_axis]
+
+        darker = workspace.buffer(f"{view}_census_darker", image.shape, np.bool_)
+        census = workspace.zeros(f"{view}_census", image.shape, np.uint64)
+        for dy, dx in offsets:
+            neighbour = padded[half + dy:half + dy + y_axis, half + dx:half + dx + x_axis]
+            census <<= np.uint64(1)
+            census |= np.less(neighbour, image, out=darker)
+        return census
+
+    return utils.run_dual(lambda: transform(left, "l"), lambda: transform(right, "r"), config)
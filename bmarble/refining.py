@@ -3,37 +3,73 @@ Functions for refining disparity maps, for better results
 
 This code was adapted from https://github.com/andreldc/pixradio, all rights reserved.
 """
+from functools import lru_cache
+
 import numpy as np
-import cv2 as cv
 
 import bmarble.utils as utils
 
+from bmarble.config import config_dict
+from bmarble.lazy import LazyModule
 from bmarble.reciprocity import get_reciprocity
+from bmarble.workspace import Workspace
+
+cv = LazyModule("cv2")
+
+CLOSING_KERNEL_SIZE = 35
+
+
+@lru_cache
+def closing_kernel(k_size):
+    """
+    Elliptical structuring element used on the closing operation, built once per size
+    """
+    kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (k_size, k_size))
+    kernel.flags.writeable = False
+    return kernel
 
 
-def get_refinement(l_valid_disparity, r_valid_disparity, l_reciprocity, r_reciprocity):
+def get_refinement(l_valid_disparity, r_valid_disparity, l_reciprocity, r_reciprocity, config = config_dict,
+                   workspace = None):
     """
     Refines the initial disparity with a closing morphological operator
     """
+    workspace = Workspace() if workspace is None else workspace
 
-    k_size = 35
+    k_size = CLOSING_KERNEL_SIZE
 
     # Defines the Kernel used for closing operation - O(1)
-    kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (k_size, k_size))
+    kernel = closing_kernel(k_size)
+
+    def close(view, valid_disparity, reciprocity):
+        # Perform Closing Operation - O(1)
+        disparity = workspace.buffer(f"{view}_closing_input", valid_disparity.shape, np.uint8)
+        np.copyto(disparity, valid_disparity, casting="unsafe")
+        closed_disparity = workspace.buffer(f"{view}_closed_disparity", valid_disparity.shape, np.uint8)
+        cv.morphologyEx(disparity, cv.MORPH_CLOSE, kernel, dst=closed_disparity)
 
-    # Perform Closing Operation - O(1)
-    l_closed_disparity = cv.morphologyEx(l_valid_disparity.astype("uint8"), cv.MORPH_CLOSE, kernel)
-    r_closed_disparity = cv.morphologyEx(r_valid_disparity.astype("uint8"), cv.MORPH_CLOSE, kernel)
+        # Substitute 0 with values found on closing operation - O(1)
+        invalid = np.equal(reciprocity, 0, out=workspace.buffer(f"{view}_invalid", reciprocity.shape, np.bool_))
+        both_disparity = workspace.buffer(f"{view}_both_disparity", valid_disparity.shape, np.int16)
+        np.copyto(both_disparity, valid_disparity)
+        np.copyto(both_disparity, closed_disparity, where=invalid)
+        return both_disparity
 
-    # Substitute 0 with values found on closing operation - O(1)
-    l_both_disparity = np.where(l_reciprocity == 0, l_closed_disparity, l_valid_disparity)
-    r_both_disparity = np.where(r_reciprocity == 0, r_closed_disparity, r_valid_disparity)
+    l_both_disparity, r_both_disparity = utils.run_dual(
+        lambda: close("l", l_valid_disparity, l_reciprocity),
+        lambda: close("r", r_valid_disparity, r_reciprocity),
+        config
+    )
 
-    cv.imwrite("./l_both_disparity.jpg", utils.convert_to_image(l_both_disparity))
-    cv.imwrite("./r_both_disparity.jpg", utils.convert_to_image(r_both_disparity))
+    if config["debug_images"]:
+        cv.imwrite("./l_both_disparity.jpg", utils.convert_to_image(l_both_disparity))
+        cv.imwrite("./r_both_disparity.jpg", utils.convert_to_image(r_both_disparity))
 
     # Aggregated Reciprocity Mask - O(N)
     l_both_disparity_valid, r_both_disparity_valid, l_both_reciprocity, r_both_reciprocity = \
-        get_reciprocity(l_both_disparity, r_both_disparity, prevent_result_override=True)
+        get_reciprocity(l_both_disparity, r_both_disparity, prevent_result_override=True, config=config,
+                        out=tuple(workspace.buffer(name, l_both_disparity.shape, np.int16)
+                                  for name in ("l_refined_valid", "r_refined_valid",
+                                               "l_refined_reciprocity", "r_refined_reciprocity")))
 
     return l_both_disparity_valid, r_both_disparity_valid, l_both_reciprocity, r_both_reciprocity
@@ -4,19 +4,46 @@ Anaglyphical reversion entry point
 Created by Felipe Carneiro Machado
 06/08/2025
 """
-import cv2
+import numpy as np
 
 import bmarble.utils as utils
 import bmarble.correspondence as correspondence
 import bmarble.colorize as colorize
 
-from bmarble.config import config_dict
-from preprocessing import laplacianOfGaussian
+from bmarble.config import config_dict, with_defaults
+from bmarble.deadline import Deadline
+from bmarble.lazy import LazyModule
+from bmarble.preprocessing import laplacianOfGaussian, census_transform, ndimage
 from bmarble.reciprocity import get_reciprocity
-from bmarble.refining import get_refinement
+from bmarble.refining import get_refinement, closing_kernel, CLOSING_KERNEL_SIZE
+from bmarble.workspace import Workspace
 
+cv2 = LazyModule("cv2")
 
-def reverse(anaglyph, config = config_dict):
+
+def warmup(config = config_dict):
+    """
+        Prepares the package for a first reversion with no setup cost
+
+        Imports the lazily loaded dependencies, builds the cached kernels and starts the dual view thread
+        pool if enabled, so that short-lived workers can pay the setup cost ahead of the first frame
+
+        Args:
+            config (dict): configuration dictionary, accepts default
+    """
+    config = with_defaults(config)
+    cv2.load()
+    ndimage.load()
+
+    # Runs the kernels once over a single block, which also initializes the libraries' internal state
+    block = np.zeros((config["block_size"], config["block_size"]), dtype=np.uint8)
+    laplacianOfGaussian(block, block, config)
+    cv2.morphologyEx(block, cv2.MORPH_CLOSE, closing_kernel(CLOSING_KERNEL_SIZE))
+    cv2.cvtColor(cv2.merge((block, block, block)), cv2.COLOR_BGR2RGB)
+
+
+def reverse(anaglyph, config = config_dict, workspace = None, deadline = None, bgr = False,
+            return_shortcuts = False):
     """
         Extracts a stereo pair from a red-cyan anaglyph
 
@@ -25,60 +52,129 @@ def reverse(anaglyph, config = config_dict):
 
         Args:
             anaglyph (numpy matrix): red-cyan anaglyph
-            config (dict): configuration dictionary, accepts default
+            config (dict): configuration dictionary, accepts default. Missing parameters take the values of
+                config_dict
+            workspace (Workspace): buffers for the intermediate results, reused across calls with frames of the
+                same size. If not given, every call allocates its own. Must not be shared by concurrent calls
+            deadline (Deadline | float): latency budget in seconds, stages cut their work short to meet it.
+                A Deadline passed in also collects the shortcuts taken. Quality presets are selected through
+                the config, see config.get_preset
+            bgr (bool): True if the anaglyph follows OpenCV's BGR channel order, the stereo pair is then
+                returned in BGR as well, which spares the color conversions of video frames
+            return_shortcuts (bool): also returns the shortcuts taken, either to meet the deadline or set by
+                the config (e.g. a preset's fill pass cap)
 
         Returns:
-            tuple[numpy matrix, numpy matrix]: stereo pair
+            tuple[numpy matrix, numpy matrix]: stereo pair, newly allocated on every call. With
+                return_shortcuts, a third element lists the shortcuts taken, see deadline.Deadline
+
+        Raises:
+            ValueError: if the anaglyph is smaller than a block along either axis
 
     """
+    # Parameters missing from the caller's config take their default value
+    config = with_defaults(config)
+    dimensions = anaglyph.shape[:2]
+    bs = config["block_size"]
+    # Frames are not padded (see utils.block_origins), so each axis must hold at least one block
+    if min(dimensions) < bs:
+        raise ValueError(f"Anaglyph of {dimensions[1]}x{dimensions[0]} pixels is smaller than a block of "
+                         f"{bs}x{bs} pixels")
+
+    workspace = Workspace() if workspace is None else workspace
+    # Shortcuts are recorded even without a time limit
+    deadline = deadline if isinstance(deadline, Deadline) else Deadline(deadline)
+    grid_shape = correspondence.block_grid_shape(dimensions, config)
+
+    # Views over the anaglyph planes, shared by every stage. Dimensions that are not block multiples are
+    # handled by the matching stage, so the frame is never padded
+    channels = utils.get_channel_views(anaglyph, bgr=bgr, workspace=workspace)
 
-    # Resizes anaglyph to divisible by block size dimensions
-    original_dimensions = anaglyph.shape
-    anaglyph = utils.resize_anaglyph(anaglyph)
-    dimensions = anaglyph.shape
+    # Computes LoG of the channels
+    log_left, log_right = laplacianOfGaussian(
+        channels.red, channels.cyan, config,
+        out=(workspace.buffer("l_log", dimensions, np.float64), workspace.buffer("r_log", dimensions, np.float64))
+    )
 
-    # Splitting channels, with color channel spreading
-    left, right = utils.split_channels(anaglyph)
+    # Images the block matching cost is computed on
+    if config["matching_cost"] == "census":
+        census_source = (log_left, log_right) if config["census_source"] == "log" else (channels.red, channels.cyan)
+        match_left, match_right = census_transform(*census_source, config, workspace=workspace)
+    else:
+        match_left, match_right = log_left, log_right
+
+    # First round of Block Matching, with large window, accumulating the disparity histograms
+    histograms = correspondence.new_histograms(dimensions, config, workspace=workspace)
+    dmap_left, dmap_right = correspondence.get_full_correspondences(
+        match_left, match_right, config, histograms=histograms,
+        out=(workspace.buffer("l_dmap", grid_shape, np.int16), workspace.buffer("r_dmap", grid_shape, np.int16)),
+        deadline=deadline
+    )
 
-    # Computes LoG of the channels
-    log_left, log_right = laplacianOfGaussian(left, right)
+    if config["rematch"]:
+        # Calculates the best window (or per region windows) based on the disparity histograms
+        new_window = correspondence.calculate_window(dmap_left, dmap_right, config, histograms=histograms)
 
-    # First round of Block Matching, with large window
-    dmap_left, dmap_right = correspondence.get_full_correspondences(log_left, log_right)
+        # Second round of Block Matching over invalid correspondences
+        final_dmap_left, final_dmap_right = correspondence.rematch_invalid_correspondences(dmap_left, dmap_right, match_left, match_right, new_window, config, deadline=deadline)
+    else:
+        deadline.take("rematch_skipped")
+        final_dmap_left, final_dmap_right = dmap_left, dmap_right
 
-    # Calculates the best window based on disparity maps
-    new_window = correspondence.calculate_window(dmap_left, dmap_right)
+    # Left disparities are stored as (negative) offsets to the right view, reciprocity expects magnitudes
+    np.abs(final_dmap_left, out=final_dmap_left)
 
-    # Second round of Block Matching over invalid correspondences
-    final_dmap_left, final_dmap_right = correspondence.rematch_invalid_correspondences(dmap_left, dmap_right, log_left, log_right, new_window)
+    # Block resolution maps are expanded to pixel resolution for reciprocity and refinement
+    expanded_shape = (grid_shape[0] * bs, grid_shape[1] * bs)
+    final_dmap_left = correspondence.expand_dmap(final_dmap_left, dimensions, config,
+                                                 out=workspace.buffer("l_dmap_expanded", expanded_shape, np.int16))
+    final_dmap_right = correspondence.expand_dmap(final_dmap_right, dimensions, config,
+                                                  out=workspace.buffer("r_dmap_expanded", expanded_shape, np.int16))
 
     # Determines valid correspondences through reciprocity
-    valid_dmap_left, valid_dmap_right, reciprocity_map_left, reciprocity_map_right = get_reciprocity(final_dmap_left, final_dmap_right)
-
-    # Refines the disparity/reciprocity maps
-    refined_valid_dmap_left, refined_valid_dmap_right, refined_reciprocity_map_left, refined_reciprocity_map_right = get_refinement(
-        valid_dmap_left, valid_dmap_right,
-        reciprocity_map_left, reciprocity_map_right
+    valid_dmap_left, valid_dmap_right, reciprocity_map_left, reciprocity_map_right = get_reciprocity(
+        final_dmap_left, final_dmap_right, config=config,
+        out=tuple(workspace.buffer(name, dimensions, np.int16)
+                  for name in ("l_valid_dmap", "r_valid_dmap", "l_reciprocity", "r_reciprocity"))
     )
 
-    # Direct color transfer on valid correspondences
+    # Refines the disparity/reciprocity maps, unless disabled or out of time
+    if config["refine"] and not deadline.expired("refinement"):
+        refined_valid_dmap_left, refined_valid_dmap_right, refined_reciprocity_map_left, refined_reciprocity_map_right = get_refinement(
+            valid_dmap_left, valid_dmap_right,
+            reciprocity_map_left, reciprocity_map_right, config, workspace=workspace
+        )
+    else:
+        deadline.take("refinement_skipped")
+        refined_valid_dmap_left, refined_valid_dmap_right, refined_reciprocity_map_left, refined_reciprocity_map_right = \
+            valid_dmap_left, valid_dmap_right, reciprocity_map_left, reciprocity_map_right
+
+    # Direct color transfer on valid correspondences, the adapted code produces BGR images
     partial_colorized_left, partial_colorized_right = colorize.recover(
-        cv2.cvtColor(anaglyph, cv2.COLOR_RGB2BGR),  # Conversion to BGR is needed for compatibility with adapted code
-        refined_valid_dmap_left, refined_valid_dmap_right
+        anaglyph, refined_valid_dmap_left, refined_valid_dmap_right, channels=channels,
+        out=(workspace.buffer("l_recovered", anaglyph.shape, np.uint8),
+             workspace.buffer("r_recovered", anaglyph.shape, np.uint8))
     )
 
     # Colorization on occluded regions
     colorized_left, colorized_right = colorize.colorize(
-        cv2.cvtColor(anaglyph, cv2.COLOR_RGB2BGR),
+        anaglyph,
         partial_colorized_left, partial_colorized_right,
-        refined_reciprocity_map_left, refined_reciprocity_map_right
+        refined_reciprocity_map_left, refined_reciprocity_map_right,
+        config, channels=channels, workspace=workspace, deadline=deadline
     )
 
-    # Returns to RGB (also compatibility related)
-    colorized_left = cv2.cvtColor(colorized_left, cv2.COLOR_BGR2RGB)
-    colorized_right = cv2.cvtColor(colorized_right, cv2.COLOR_BGR2RGB)
-
-    # Removes padding
-    result_left, result_right = utils.return_dimensions(colorized_left, colorized_right, dimensions)
-
+    if bgr:
+        # BGR frames are returned as they are, copied out of the workspace
+        result_left, result_right = colorized_left.copy(), colorized_right.copy()
+    else:
+        # Returns to RGB (also compatibility related), the results are not kept in the workspace
+        result_left, result_right = utils.run_dual(
+            lambda: cv2.cvtColor(colorized_left, cv2.COLOR_BGR2RGB),
+            lambda: cv2.cvtColor(colorized_right, cv2.COLOR_BGR2RGB),
+            config
+        )
+
+    if return_shortcuts:
+        return result_left, result_right, list(deadline.shortcuts)
     return result_left, result_right
@@ -4,54 +4,82 @@ General utilities
 Created by Felipe Carneiro Machado
 06/08/2025
 """
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
 from bmarble.config import config_dict
+from bmarble.workspace import Workspace
 
-import cv2 as cv
 import numpy as np
 
 
 
-def resize_anaglyph(anaglyph, config = config_dict):
+# Planes of a red-cyan anaglyph, shared by the preprocessing, recovery and colorization stages
+ChannelViews = namedtuple("ChannelViews", ["red", "green", "blue", "cyan"])
+
+def get_channel_views(anaglyph : np.ndarray, bgr : bool = False, workspace : Workspace = None):
     """
-    Resizes anaglyph image to divisible by block size dimensions
-    :param anaglyph: input anaglyph image
-    :param config: config dictionary, supports default
-    :return: resized anaglyph image
+    Exposes the anaglyph planes as 2D views, computed once per frame
+    Red, green and blue are strided views over the anaglyph, only the merged cyan plane is allocated
+    :param anaglyph: anaglyph image
+    :param bgr: True if the anaglyph follows OpenCV's BGR channel order, False for RGB
+    :param workspace: Workspace holding the cyan plane and its scratch buffers, allocates them if not given
+    :return: ChannelViews(red, green, blue, cyan)
     """
-    f = lambda x : (config["block_size"] - (x % config["block_size"])
-                    if x % config["block_size"] != 0
-                    else 0)
-    #Resizing the channels
-    resized = cv.copyMakeBorder(anaglyph
-                                  , 0,
-                                  f(anaglyph.shape[0]),
-                                  0,
-                                  f(anaglyph.shape[1]),
-                                  cv.BORDER_CONSTANT,
-                                  value=[0, 0, 0])
-    return resized
+    workspace = Workspace() if workspace is None else workspace
+
+    red = anaglyph[:, :, 2 if bgr else 0]
+    green = anaglyph[:, :, 1]
+    blue = anaglyph[:, :, 0 if bgr else 2]
 
-# Return the channels to the original dimensions
-def return_dimensions(result_left:np.ndarray, result_right:np.ndarray, dimensions:np.shape, config:dict = config_dict):
-    l = result_left[:dimensions[0], :dimensions[1]]
-    r = result_right[:dimensions[0], :dimensions[1]]
-    return l, r
+    # cyan = rint(green * 0.95 + blue * (1 - 0.95)), evaluated into the workspace buffers
+    weighted_green = np.multiply(green, 0.95, out=workspace.buffer("weighted_green", green.shape, np.float64))
+    weighted_blue = np.multiply(blue, 1 - 0.95, out=workspace.buffer("weighted_blue", blue.shape, np.float64))
+    np.rint(np.add(weighted_green, weighted_blue, out=weighted_green), out=weighted_green)
+    cyan = workspace.buffer("cyan", green.shape, np.uint8)
+    np.copyto(cyan, weighted_green, casting="unsafe")
+    return ChannelViews(red, green, blue, cyan)
 
-def split_channels(anaglyph : np.ndarray, config : dict = config_dict):
+def block_origins(length : int, config : dict = config_dict):
     """
-    Splits channels, with color channel spreading to empty channels
-    :param anaglyph:
+    Top left coordinates of the blocks covering an axis of the image
+    When the length is not a block multiple, the last block is shifted back to end at the image border,
+    which avoids padding the frame. Axes shorter than a block are not supported, see reverse
+    :param length: axis length
     :param config:
-    :return:
+    :return: list of block coordinates along the axis
     """
-    # Follows red-cyan pattern
-    l = anaglyph.copy()
-    l[:, :, 1] = l[:, :, 0]
-    l[:, :, 2] = l[:, :, 0]
-    r = anaglyph.copy()
-    r[:, :, 0] = r[:, :, 1]
-    return l, r
+    bs = config["block_size"]
+    return [min(origin, length - bs) for origin in range(0, length, bs)]
+
 
+# Shared by every frame, created on first use
+_DUAL_VIEW_POOL = None
+_DUAL_VIEW_POOL_LOCK = threading.Lock()
+
+def run_dual(left_task, right_task, config : dict = config_dict):
+    """
+    Runs the independent left and right halves of a stage
+    With "dual_view_threads" enabled, the left task runs on a shared thread pool while the right one runs on the
+    calling thread. NumPy, SciPy and OpenCV release the GIL on their heavy operations, so both halves overlap.
+    Only meant for such tasks, halves looping in Python would just take turns on the GIL
+    :param left_task: callable without arguments
+    :param right_task: callable without arguments
+    :param config:
+    :return: (left result, right result)
+    """
+    global _DUAL_VIEW_POOL
+    if not config["dual_view_threads"]:
+        return left_task(), right_task()
+
+    with _DUAL_VIEW_POOL_LOCK:
+        if _DUAL_VIEW_POOL is None:
+            _DUAL_VIEW_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="bmarble")
+    left_future = _DUAL_VIEW_POOL.submit(left_task)
+    right_result = right_task()
+    return left_future.result(), right_result
 
 
 def valid_coordinate(y: int, x: int, dimensions: tuple[int, int, int]):
@@ -90,33 +118,12 @@ def valid_block(y, x, dimensions, config = config_dict):
     else:
         return False
 
-def get_anaglyph_channels(anaglyph, avoid_image_show=False, config = config_dict):
-    """
-    Maps anaglyph to Left and Right channels
-
-    This code was adapted from https://github.com/andreldc/pixradio, all rights reserved.
-    Parameters:
-    anaglyph (uint8 np.array): Anaglyph image
-    right_left_factor (float): Factor for merging Right channel image
-
-    Returns:
-    l_channel, r_channel, r1_channel, r2_channel (uint8 cv2 image np.array):
-    l_channel is the left channel
-    r_channel is the merged right channel
-    r1_channel and r2_channel are the right channel
 
-    Requirements:
+def count_if(array, value):
     """
-    blue, green, red = cv.split(anaglyph)
-
-    l_channel = red
-    r1_channel = green
-    r2_channel = blue
-    r_channel = np.rint(r1_channel * 0.95 +
-                        r2_channel * (1 - 0.95)
-                        ).astype("uint8")
-
-    return (l_channel, r_channel, r1_channel, r2_channel)
+    Counts the elements of array equal to value
+    """
+    return np.count_nonzero(array == value)
 
 
 def change_range(vector, old_min, old_max, new_min, new_max):
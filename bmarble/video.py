@@ -0,0 +1,209 @@
+"""
+Streaming reversion of anaglyph videos
+
+Frames are decoded with cv2.VideoCapture, reversed concurrently by a pool of workers and encoded with
+cv2.VideoWriter in their original order, without intermediate files. Bounded queues keep the number of frames
+in flight (and so the memory used) constant, whatever the length of the video.
+
+Thread workers share the process, so the occlusion fill (a per-pixel Python loop holding the GIL) runs one
+frame at a time and the frame rate barely grows past a couple of workers. Process workers scale with the CPUs
+at the cost of sending every frame and its views between processes.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from bmarble.config import config_dict, with_defaults
+from bmarble.lazy import LazyModule
+from bmarble.reverse import reverse
+from bmarble.workspace import Workspace
+
+cv2 = LazyModule("cv2")
+
+LAYOUTS = ("sbs", "pair")
+EXECUTORS = ("thread", "process")
+
+# Frames written, wall time from the first decoded frame to the last encoded one, sustained frames per second
+# and number of frames that took a shortcut, to meet their deadline or set by the config
+VideoStats = namedtuple("VideoStats", ("frames", "seconds", "fps", "degraded_frames"))
+
+
+# Config, frame deadline and Workspace of a process worker, set once by _init_process
+_process_state = {}
+
+
+def _init_process(config, frame_deadline):
+    """
+    Initializer of the process workers, each process owns a Workspace reused across the frames it reverses
+    """
+    _process_state.update(config=config, frame_deadline=frame_deadline, workspace=Workspace())
+
+
+def _reverse_frame_in_process(frame):
+    """
+    Reverses a frame in a process worker
+    :return: (left, right, degraded)
+    """
+    left, right, shortcuts = reverse(frame, _process_state["config"], workspace=_process_state["workspace"],
+                                     deadline=_process_state["frame_deadline"], bgr=True, return_shortcuts=True)
+    return left, right, bool(shortcuts)
+
+
+def _open_writers(destination, layout, fourcc, fps, frame_shape):
+    """
+    Opens the output videos for frames of the given shape
+    :return: list of cv2.VideoWriter, one for the side by side layout, left and right for the pair layout
+    """
+    height, width = frame_shape[:2]
+    if layout == "sbs":
+        paths, size = (destination,), (2 * width, height)
+    else:
+        paths, size = destination, (width, height)
+
+    writers = []
+    for path in paths:
+        writer = cv2.VideoWriter(os.fspath(path), cv2.VideoWriter_fourcc(*fourcc), fps, size)
+        if not writer.isOpened():
+            for opened in writers:
+                opened.release()
+            raise OSError(f"Cannot open {path} for writing with the {fourcc} codec")
+        writers.append(writer)
+    return writers
+
+
+def _write_frames(pending, open_writers, layout, state):
+    """
+    Writer loop, encodes the reversed frames in the order they were submitted
+    Keeps draining the queue after an error, so that the reader is never blocked on a full queue
+    :param pending: queue of futures of (left, right, degraded), None ends the loop
+    :param open_writers: callable opening the writers given the shape of the first frame
+    :param layout: "sbs" or "pair"
+    :param state: dictionary shared with the reader, holds the writers, the counters and the first error
+    """
+    while True:
+        future = pending.get()
+        if future is None:
+            return
+        if state["error"] is not None:
+            future.cancel()
+            continue
+        try:
+            left, right, degraded = future.result()
+            if not state["writers"]:
+                state["writers"] = open_writers(left.shape)
+            if layout == "sbs":
+                state["writers"][0].write(np.concatenate((left, right), axis=1))
+            else:
+                state["writers"][0].write(left)
+                state["writers"][1].write(right)
+        except BaseException as error:
+            state["error"] = error
+            continue
+        state["frames"] += 1
+        state["degraded_frames"] += degraded
+
+
+def reverse_video(source, destination, config = config_dict, layout = "sbs", workers = None, queue_size = None,
+                  fourcc = "mp4v", frame_deadline = None, executor = "thread"):
+    """
+        Reverses every frame of an anaglyph video into a stereo video
+
+        The calling thread decodes the frames and submits them to the workers, each of which owns a Workspace,
+        while a writer thread encodes the results in order. Frames stay in OpenCV's BGR order from decoding to
+        encoding. The refinement debug images are disabled, as the workers would overwrite each other's files
+
+        Thread workers are limited by the GIL held by the occlusion fill, use process workers to scale with the
+        CPUs. Process workers are started with the "spawn" method, so scripts using them need an
+        if __name__ == "__main__" guard
+
+        Args:
+            source (str | int): path, URL or camera index of the anaglyph video, as accepted by cv2.VideoCapture
+            destination (str | tuple[str, str]): output path for the "sbs" layout, (left path, right path)
+                for the "pair" layout
+            config (dict): configuration dictionary, accepts default, missing parameters take their default value
+            layout (str): "sbs" to write the views side by side on a single video, "pair" for two videos
+            workers (int): number of frames reversed concurrently, defaults to the number of CPUs
+            queue_size (int): maximum number of frames waiting to be written, defaults to twice the workers
+            fourcc (str): four character code of the output codec
+            frame_deadline (float): latency budget of each frame in seconds, see reverse
+            executor (str): "thread" to reverse the frames on threads, "process" on processes
+
+        Returns:
+            VideoStats: frames written, seconds spent, sustained frames per second and frames that took a shortcut
+
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout {layout!r}, expected one of {', '.join(LAYOUTS)}")
+    if layout == "pair" and (isinstance(destination, (str, os.PathLike)) or len(destination) != 2):
+        raise ValueError("The pair layout expects a (left path, right path) destination")
+    if executor not in EXECUTORS:
+        raise ValueError(f"Unknown executor {executor!r}, expected one of {', '.join(EXECUTORS)}")
+
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    queue_size = 2 * workers if queue_size is None else queue_size
+    config = {**with_defaults(config), "debug_images": False}
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise OSError(f"Cannot open video {source}")
+    # Some containers and cameras report no frame rate
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+
+    # One workspace per worker thread, reused across the frames it reverses
+    local = threading.local()
+
+    def reverse_frame(frame):
+        if not hasattr(local, "workspace"):
+            local.workspace = Workspace()
+        left, right, shortcuts = reverse(frame, config, workspace=local.workspace, deadline=frame_deadline, bgr=True,
+                                         return_shortcuts=True)
+        return left, right, bool(shortcuts)
+
+    pending = queue.Queue(maxsize=queue_size)
+    state = {"writers": [], "frames": 0, "degraded_frames": 0, "error": None}
+    writer = threading.Thread(
+        target=_write_frames,
+        args=(pending, lambda shape: _open_writers(destination, layout, fourcc, fps, shape), layout, state),
+        daemon=True
+    )
+
+    start = time.perf_counter()
+    try:
+        if executor == "process":
+            # Spawned rather than forked, a fork would copy the running writer and dual view threads as dead threads
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_process, initargs=(config, frame_deadline))
+            work = _reverse_frame_in_process
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bmarble-video")
+            work = reverse_frame
+
+        with pool:
+            writer.start()
+            try:
+                while state["error"] is None:
+                    read, frame = capture.read()
+                    if not read:
+                        break
+                    # Blocks while the queue is full, so decoding never runs ahead of encoding
+                    pending.put(pool.submit(work, frame))
+            finally:
+                pending.put(None)
+                writer.join()
+    finally:
+        capture.release()
+        for opened in state["writers"]:
+            opened.release()
+    seconds = time.perf_counter() - start
+
+    if state["error"] is not None:
+        raise state["error"]
+
+    return VideoStats(state["frames"], seconds, state["frames"] / seconds if seconds > 0 else 0.0,
+                      state["degraded_frames"])
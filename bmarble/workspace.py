@@ -0,0 +1,54 @@
+"""
+Reusable buffers for the reversion stages, avoids per-frame allocations on video and batch workloads
+"""
+import numpy as np
+
+
+class Workspace:
+    """
+    Owns the buffers the reversion stages write into
+
+    Buffers are allocated by name on first request and handed back on the following ones, so consecutive
+    frames of the same size reuse the same memory. Requesting a buffer with another shape or dtype (e.g. for
+    a frame of a different size) replaces it. A workspace must not be shared by concurrent reversions.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def buffer(self, name, shape, dtype):
+        """
+        Returns the named buffer, contents are left from its previous use
+        :param name: buffer name, unique per stage and view
+        :param shape:
+        :param dtype:
+        :return: numpy array
+        """
+        shape = tuple(int(n) for n in shape)
+        dtype = np.dtype(dtype)
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+    def zeros(self, name, shape, dtype):
+        """
+        Returns the named buffer, filled with zeros
+        """
+        return self.full(name, shape, dtype, 0)
+
+    def full(self, name, shape, dtype, value):
+        """
+        Returns the named buffer, filled with value
+        """
+        buffer = self.buffer(name, shape, dtype)
+        buffer.fill(value)
+        return buffer
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the buffers, in bytes
+        """
+        return sum(buffer.nbytes for buffer in self._buffers.values())